@@ -1,32 +1,142 @@
+import asyncio
+import hashlib
+import hmac
 import os
-from typing import Optional
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
 
-from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
-from passlib.context import CryptContext
+import bcrypt
+from argon2 import PasswordHasher, Type
+from argon2.exceptions import InvalidHashError, VerificationError
+from cachetools import TTLCache
 
 SECRET_KEY = os.environ.get("SECRET_KEY", "dev-secret-key-change-me")
 SESSION_COOKIE = "session"
 SESSION_MAX_AGE = 60 * 60 * 24 * 14
+VERIFY_CACHE_SIZE = 4096
+VERIFY_CACHE_TTL = 5 * 60
+USER_CACHE_SIZE = 10000
+# The cache is per process: after password_version is bumped, other workers
+# keep accepting older tokens for up to USER_CACHE_TTL seconds.
+USER_CACHE_TTL = 60
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-serializer = URLSafeTimedSerializer(SECRET_KEY)
+BCRYPT_PREFIXES = ("$2a$", "$2b$", "$2y$")
+ARGON2_PREFIX = "$argon2id$"
+
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1, type=Type.ID)
+
+UserView = namedtuple("UserView", ["id", "username", "password_version"])
+
+_verify_cache: "OrderedDict[bytes, tuple[float, bool, str]]" = OrderedDict()
+_verify_cache_lock = threading.Lock()
+_user_cache: TTLCache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_user_cache_lock = threading.Lock()
+_password_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="password")
 
 
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    return password_hasher.hash(password)
+
+
+def _check_password(plain_password: str, hashed_password: str) -> bool:
+    if hashed_password.startswith(ARGON2_PREFIX):
+        try:
+            return password_hasher.verify(hashed_password, plain_password)
+        except (InvalidHashError, VerificationError):
+            return False
+    if hashed_password.startswith(BCRYPT_PREFIXES):
+        return bcrypt.checkpw(plain_password.encode()[:72], hashed_password.encode())
+    return False
+
+
+def _verify_cache_key(plain_password: str, hashed_password: str) -> bytes:
+    message = plain_password.encode() + b"\x00" + hashed_password.encode()
+    return hmac.new(SECRET_KEY.encode(), message, hashlib.sha256).digest()
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    key = _verify_cache_key(plain_password, hashed_password)
+    now = time.monotonic()
+    with _verify_cache_lock:
+        cached = _verify_cache.get(key)
+        if cached is not None:
+            expires_at, result, _ = cached
+            if expires_at > now:
+                _verify_cache.move_to_end(key)
+                return result
+            del _verify_cache[key]
+    result = _check_password(plain_password, hashed_password)
+    with _verify_cache_lock:
+        _verify_cache[key] = (now + VERIFY_CACHE_TTL, result, hashed_password)
+        _verify_cache.move_to_end(key)
+        while len(_verify_cache) > VERIFY_CACHE_SIZE:
+            _verify_cache.popitem(last=False)
+    return result
+
+
+def password_needs_update(hashed_password: str) -> bool:
+    if not hashed_password.startswith(ARGON2_PREFIX):
+        return True
+    return password_hasher.check_needs_rehash(hashed_password)
+
+
+def invalidate_password_cache(hashed_password: str) -> None:
+    with _verify_cache_lock:
+        stale = [key for key, entry in _verify_cache.items() if entry[2] == hashed_password]
+        for key in stale:
+            del _verify_cache[key]
+
+
+async def ahash_password(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_password_pool, hash_password, password)
 
 
-def create_session_token(user_id: int) -> str:
-    return serializer.dumps({"user_id": user_id})
+async def averify_password(plain_password: str, hashed_password: str) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_password_pool, verify_password, plain_password, hashed_password)
 
 
-def read_session_token(token: str) -> Optional[int]:
+def get_cached_user(user_id: int) -> Optional[UserView]:
+    with _user_cache_lock:
+        return _user_cache.get(user_id)
+
+
+def cache_user(user_id: int, username: str, password_version: int) -> UserView:
+    user = UserView(user_id, username, password_version)
+    with _user_cache_lock:
+        _user_cache[user_id] = user
+    return user
+
+
+def invalidate_user(user_id: int) -> None:
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+
+
+def _sign_session(payload: str) -> str:
+    return hmac.new(SECRET_KEY.encode(), payload.encode(), hashlib.sha256).hexdigest()
+
+
+def create_session_token(user_id: int, password_version: int) -> str:
+    payload = f"{user_id}.{password_version}.{int(time.time())}"
+    return f"{payload}.{_sign_session(payload)}"
+
+
+def read_session_token(token: str) -> Optional[Tuple[int, int]]:
+    parts = token.split(".")
+    if len(parts) != 4:
+        return None
+    payload = ".".join(parts[:3])
+    if not hmac.compare_digest(parts[3].encode(), _sign_session(payload).encode()):
+        return None
     try:
-        data = serializer.loads(token, max_age=SESSION_MAX_AGE)
-    except (BadSignature, SignatureExpired):
+        user_id, password_version, issued_at = (int(part) for part in parts[:3])
+    except ValueError:
+        return None
+    if time.time() - issued_at > SESSION_MAX_AGE:
         return None
-    return data.get("user_id")
+    return user_id, password_version
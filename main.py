@@ -1,51 +1,141 @@
+import hashlib
+import os
+import stat
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Optional
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
 
-from fastapi import Depends, FastAPI, Form, HTTPException, Request
-from fastapi.responses import RedirectResponse
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.responses import RedirectResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from sqlalchemy import func
-from sqlalchemy.orm import Session
-
-from auth import SESSION_COOKIE, create_session_token, hash_password, read_session_token, verify_password
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import func, lambda_stmt, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.datastructures import FormData
+
+from auth import (
+    SESSION_COOKIE,
+    UserView,
+    ahash_password,
+    averify_password,
+    cache_user,
+    create_session_token,
+    get_cached_user,
+    invalidate_password_cache,
+    invalidate_user,
+    password_needs_update,
+    read_session_token,
+)
 from db import Base, SessionLocal, engine
 from models import DebtGroup, DebtItem, User
 
-Base.metadata.create_all(bind=engine)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield
+    await engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+CENT = Decimal("0.01")
+MAX_AMOUNT = Decimal("1e12")
+TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR")
+TEMPLATES_AUTO_RELOAD = os.environ.get("TEMPLATES_AUTO_RELOAD") == "1"
+
+
+def template_bytecode_cache() -> FileSystemBytecodeCache:
+    if not TEMPLATE_CACHE_DIR:
+        return FileSystemBytecodeCache()
+    os.makedirs(TEMPLATE_CACHE_DIR, mode=0o700, exist_ok=True)
+    info = os.lstat(TEMPLATE_CACHE_DIR)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or stat.S_IMODE(info.st_mode) & 0o077:
+        raise RuntimeError(f"Template cache directory {TEMPLATE_CACHE_DIR} must be owned by this user with mode 0700")
+    return FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
+
+
 templates = Jinja2Templates(directory="templates")
+templates.env.bytecode_cache = template_bytecode_cache()
+templates.env.auto_reload = TEMPLATES_AUTO_RELOAD
+for template_name in templates.env.list_templates():
+    templates.env.get_template(template_name)
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+def templates_version() -> str:
+    digest = hashlib.sha256()
+    for name in templates.env.list_templates():
+        source, _, _ = templates.env.loader.get_source(templates.env, name)
+        digest.update(name.encode() + b"\x00" + source.encode() + b"\x00")
+    return digest.hexdigest()[:16]
+
+
+TEMPLATES_VERSION = templates_version()
+
+
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-def get_current_user(request: Request, db: Session = Depends(get_db)) -> User:
+class AuthRedirect(Exception):
+    pass
+
+
+@app.exception_handler(AuthRedirect)
+async def auth_redirect_handler(request: Request, exc: AuthRedirect):
+    return RedirectResponse("/login", status_code=302)
+
+
+async def require_user(request: Request, db: AsyncSession = Depends(get_db)) -> UserView:
     token = request.cookies.get(SESSION_COOKIE)
     if not token:
-        raise HTTPException(status_code=401)
-    user_id = read_session_token(token)
-    if not user_id:
-        raise HTTPException(status_code=401)
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
-        raise HTTPException(status_code=401)
+        raise AuthRedirect()
+    session = read_session_token(token)
+    if not session:
+        raise AuthRedirect()
+    user_id, password_version = session
+    user = get_cached_user(user_id)
+    if not user or user.password_version < password_version:
+        db_user = await db.get(User, user_id)
+        if not db_user:
+            raise AuthRedirect()
+        user = cache_user(db_user.id, db_user.username, db_user.password_version)
+    if user.password_version != password_version:
+        raise AuthRedirect()
     return user
 
 
-def require_user(request: Request, db: Session = Depends(get_db)) -> User:
-    try:
-        return get_current_user(request, db)
-    except HTTPException:
-        raise HTTPException(status_code=302, headers={"Location": "/login"})
+def make_etag(user_id: int, *stamps) -> str:
+    parts = [TEMPLATES_VERSION, str(user_id)]
+    for last_created, count in stamps:
+        parts.append(last_created.isoformat() if last_created else "")
+        parts.append(str(count))
+    return 'W/"' + ":".join(parts) + '"'
+
+
+def cache_headers(etag: str) -> dict:
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in header.split(","))
+
+
+def form_value(form: FormData, name: str) -> str:
+    value = form.get(name)
+    if not isinstance(value, str) or not value:
+        raise HTTPException(status_code=422, detail=f"Missing form field: {name}")
+    return value
 
 
 @app.get("/")
@@ -59,19 +149,23 @@ async def register_page(request: Request):
 
 
 @app.post("/register")
-async def register(request: Request, username: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
-    existing = db.query(User).filter(User.username == username).first()
+async def register(request: Request, db: AsyncSession = Depends(get_db)):
+    form = await request.form()
+    username = form_value(form, "username")
+    password = form_value(form, "password")
+    existing = await db.scalar(lambda_stmt(lambda: select(User).where(User.username == username)))
     if existing:
         return templates.TemplateResponse(
             "register.html",
             {"request": request, "error": "Это имя уже занято."},
             status_code=400,
         )
-    user = User(username=username, password_hash=hash_password(password))
+    user = User(username=username, password_hash=await ahash_password(password))
     db.add(user)
-    db.commit()
-    db.refresh(user)
-    token = create_session_token(user.id)
+    await db.commit()
+    await db.refresh(user)
+    invalidate_user(user.id)
+    token = create_session_token(user.id, user.password_version)
     response = RedirectResponse("/dashboard", status_code=302)
     response.set_cookie(
         SESSION_COOKIE,
@@ -88,15 +182,22 @@ async def login_page(request: Request):
 
 
 @app.post("/login")
-async def login(request: Request, username: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == username).first()
-    if not user or not verify_password(password, user.password_hash):
+async def login(request: Request, db: AsyncSession = Depends(get_db)):
+    form = await request.form()
+    username = form_value(form, "username")
+    password = form_value(form, "password")
+    user = await db.scalar(lambda_stmt(lambda: select(User).where(User.username == username)))
+    if not user or not await averify_password(password, user.password_hash):
         return templates.TemplateResponse(
             "login.html",
             {"request": request, "error": "Неверный логин или пароль."},
             status_code=400,
         )
-    token = create_session_token(user.id)
+    if password_needs_update(user.password_hash):
+        invalidate_password_cache(user.password_hash)
+        user.password_hash = await ahash_password(password)
+        await db.commit()
+    token = create_session_token(user.id, user.password_version)
     response = RedirectResponse("/dashboard", status_code=302)
     response.set_cookie(
         SESSION_COOKIE,
@@ -115,52 +216,87 @@ async def logout():
 
 
 @app.get("/dashboard")
-async def dashboard(request: Request, db: Session = Depends(get_db), user: User = Depends(require_user)):
-    group_balances = (
-        db.query(DebtGroup, func.coalesce(func.sum(DebtItem.amount), 0.0))
-        .outerjoin(DebtItem, DebtItem.group_id == DebtGroup.id)
-        .filter(DebtGroup.user_id == user.id)
-        .group_by(DebtGroup.id)
-        .order_by(DebtGroup.created_at.desc())
-        .all()
+async def dashboard(request: Request, db: AsyncSession = Depends(get_db), user: UserView = Depends(require_user)):
+    user_id = user.id
+    stamps = await db.execute(
+        lambda_stmt(
+            lambda: select(
+                select(func.max(DebtGroup.created_at)).where(DebtGroup.user_id == user_id).scalar_subquery(),
+                select(func.count()).where(DebtGroup.user_id == user_id).scalar_subquery(),
+                select(func.max(DebtItem.created_at)).where(DebtItem.user_id == user_id).scalar_subquery(),
+                select(func.count()).where(DebtItem.user_id == user_id).scalar_subquery(),
+            )
+        )
     )
-    total_balance = (
-        db.query(func.coalesce(func.sum(DebtItem.amount), 0.0))
-        .filter(DebtItem.user_id == user.id)
-        .scalar()
-        or 0.0
+    groups_created, groups_count, items_created, items_count = stamps.one()
+    etag = make_etag(user_id, (groups_created, groups_count), (items_created, items_count))
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=cache_headers(etag))
+    result = await db.execute(
+        lambda_stmt(
+            lambda: select(
+                DebtGroup.id,
+                DebtGroup.name,
+                DebtGroup.balance,
+                func.sum(DebtGroup.balance).over().label("total"),
+            )
+            .where(DebtGroup.user_id == user_id)
+            .order_by(DebtGroup.created_at.desc())
+        )
     )
+    groups = result.all()
+    total_balance = groups[0].total if groups else Decimal(0)
     return templates.TemplateResponse(
         "dashboard.html",
         {
             "request": request,
             "user": user,
-            "groups": group_balances,
+            "groups": groups,
             "total_balance": total_balance,
         },
+        headers=cache_headers(etag),
     )
 
 
 @app.post("/groups")
-async def create_group(name: str = Form(...), db: Session = Depends(get_db), user: User = Depends(require_user)):
+async def create_group(request: Request, db: AsyncSession = Depends(get_db), user: UserView = Depends(require_user)):
+    form = await request.form()
+    name = form_value(form, "name")
     group = DebtGroup(user_id=user.id, name=name)
     db.add(group)
-    db.commit()
+    await db.commit()
     return RedirectResponse("/dashboard", status_code=302)
 
 
 @app.get("/groups/{group_id}")
-async def group_detail(request: Request, group_id: int, db: Session = Depends(get_db), user: User = Depends(require_user)):
-    group = db.query(DebtGroup).filter(DebtGroup.id == group_id, DebtGroup.user_id == user.id).first()
-    if not group:
+async def group_detail(request: Request, group_id: int, db: AsyncSession = Depends(get_db), user: UserView = Depends(require_user)):
+    group = await db.get(DebtGroup, group_id)
+    if not group or group.user_id != user.id:
         raise HTTPException(status_code=404)
-    items = (
-        db.query(DebtItem)
-        .filter(DebtItem.group_id == group.id, DebtItem.user_id == user.id)
-        .order_by(DebtItem.created_at.desc())
-        .all()
+    user_id = user.id
+    stamp = await db.execute(
+        lambda_stmt(
+            lambda: select(func.max(DebtItem.created_at), func.count()).where(
+                DebtItem.group_id == group_id, DebtItem.user_id == user_id
+            )
+        )
+    )
+    etag = make_etag(user_id, stamp.one())
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=cache_headers(etag))
+    result = await db.execute(
+        lambda_stmt(
+            lambda: select(
+                DebtItem.id,
+                DebtItem.amount,
+                DebtItem.note,
+                DebtItem.created_at,
+            )
+            .where(DebtItem.group_id == group_id, DebtItem.user_id == user_id)
+            .order_by(DebtItem.created_at.desc())
+        )
     )
-    balance = sum(item.amount for item in items)
+    items = result.all()
     return templates.TemplateResponse(
         "group.html",
         {
@@ -168,25 +304,33 @@ async def group_detail(request: Request, group_id: int, db: Session = Depends(ge
             "user": user,
             "group": group,
             "items": items,
-            "balance": balance,
+            "balance": group.balance,
         },
+        headers=cache_headers(etag),
     )
 
 
 @app.post("/groups/{group_id}/items")
 async def add_item(
+    request: Request,
     group_id: int,
-    amount: float = Form(...),
-    note: Optional[str] = Form(None),
-    db: Session = Depends(get_db),
-    user: User = Depends(require_user),
+    db: AsyncSession = Depends(get_db),
+    user: UserView = Depends(require_user),
 ):
-    group = db.query(DebtGroup).filter(DebtGroup.id == group_id, DebtGroup.user_id == user.id).first()
-    if not group:
+    form = await request.form()
+    try:
+        amount = Decimal(form_value(form, "amount")).quantize(CENT, rounding=ROUND_HALF_UP)
+    except InvalidOperation:
+        raise HTTPException(status_code=422, detail="Invalid amount")
+    if not amount.is_finite() or abs(amount) >= MAX_AMOUNT:
+        raise HTTPException(status_code=422, detail="Invalid amount")
+    note = form.get("note") or None
+    group = await db.get(DebtGroup, group_id)
+    if not group or group.user_id != user.id:
         raise HTTPException(status_code=404)
     item = DebtItem(user_id=user.id, group_id=group.id, amount=amount, note=note)
     db.add(item)
-    db.commit()
+    await db.commit()
     return RedirectResponse(f"/groups/{group.id}", status_code=302)
 
 
@@ -194,36 +338,28 @@ async def add_item(
 async def delete_item(
     group_id: int,
     item_id: int,
-    db: Session = Depends(get_db),
-    user: User = Depends(require_user),
+    db: AsyncSession = Depends(get_db),
+    user: UserView = Depends(require_user),
 ):
-    item = (
-        db.query(DebtItem)
-        .filter(
-            DebtItem.id == item_id,
-            DebtItem.group_id == group_id,
-            DebtItem.user_id == user.id,
-        )
-        .first()
-    )
-    if not item:
+    item = await db.get(DebtItem, item_id)
+    if not item or item.group_id != group_id or item.user_id != user.id:
         raise HTTPException(status_code=404)
-    db.delete(item)
-    db.commit()
+    await db.delete(item)
+    await db.commit()
     return RedirectResponse(f"/groups/{group_id}", status_code=302)
 
 
 @app.post("/groups/{group_id}/delete")
 async def delete_group(
     group_id: int,
-    db: Session = Depends(get_db),
-    user: User = Depends(require_user),
+    db: AsyncSession = Depends(get_db),
+    user: UserView = Depends(require_user),
 ):
-    group = db.query(DebtGroup).filter(DebtGroup.id == group_id, DebtGroup.user_id == user.id).first()
-    if not group:
+    group = await db.get(DebtGroup, group_id)
+    if not group or group.user_id != user.id:
         raise HTTPException(status_code=404)
-    db.delete(group)
-    db.commit()
+    await db.delete(group)
+    await db.commit()
     return RedirectResponse("/dashboard", status_code=302)
 
 
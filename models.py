@@ -1,10 +1,12 @@
 from datetime import datetime
 
-from sqlalchemy import Column, DateTime, Float, ForeignKey, Integer, String, Text
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, Numeric, String, Text, event, func, update
 from sqlalchemy.orm import relationship
 
 from db import Base
 
+Money = Numeric(14, 2)
+
 
 class User(Base):
     __tablename__ = "users"
@@ -12,9 +14,10 @@ class User(Base):
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, unique=True, index=True, nullable=False)
     password_hash = Column(String, nullable=False)
+    password_version = Column(Integer, nullable=False, default=0, server_default="0")
 
-    groups = relationship("DebtGroup", back_populates="user", cascade="all, delete-orphan")
-    items = relationship("DebtItem", back_populates="user", cascade="all, delete-orphan")
+    groups = relationship("DebtGroup", back_populates="user", cascade="all, delete-orphan", lazy="raise")
+    items = relationship("DebtItem", back_populates="user", cascade="all, delete-orphan", lazy="raise")
 
 
 class DebtGroup(Base):
@@ -23,10 +26,15 @@ class DebtGroup(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     name = Column(String, nullable=False)
+    balance = Column(Money, nullable=False, default=0, server_default="0")
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
 
-    user = relationship("User", back_populates="groups")
-    items = relationship("DebtItem", back_populates="group", cascade="all, delete-orphan")
+    user = relationship("User", back_populates="groups", lazy="raise")
+    items = relationship(
+        "DebtItem", back_populates="group", cascade="all, delete-orphan", passive_deletes=True, lazy="raise"
+    )
+
+    __table_args__ = (Index("ix_groups_user_created", "user_id", created_at.desc()),)
 
 
 class DebtItem(Base):
@@ -34,10 +42,33 @@ class DebtItem(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    group_id = Column(Integer, ForeignKey("debt_groups.id"), nullable=False)
-    amount = Column(Float, nullable=False)
+    group_id = Column(Integer, ForeignKey("debt_groups.id", ondelete="CASCADE"), nullable=False)
+    amount = Column(Money, nullable=False)
     note = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
 
-    user = relationship("User", back_populates="items")
-    group = relationship("DebtGroup", back_populates="items")
+    user = relationship("User", back_populates="items", lazy="raise")
+    group = relationship("DebtGroup", back_populates="items", lazy="raise")
+
+    __table_args__ = (
+        Index("ix_items_user_created", "user_id", created_at.desc()),
+        Index("ix_items_group_user_created", "group_id", "user_id", created_at.desc()),
+    )
+
+
+@event.listens_for(DebtItem, "after_insert")
+def _add_item_to_balance(mapper, connection, item):
+    connection.execute(
+        update(DebtGroup.__table__)
+        .where(DebtGroup.id == item.group_id)
+        .values(balance=func.round(DebtGroup.balance + item.amount, 2))
+    )
+
+
+@event.listens_for(DebtItem, "after_delete")
+def _remove_item_from_balance(mapper, connection, item):
+    connection.execute(
+        update(DebtGroup.__table__)
+        .where(DebtGroup.id == item.group_id)
+        .values(balance=func.round(DebtGroup.balance - item.amount, 2))
+    )